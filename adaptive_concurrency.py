@@ -0,0 +1,137 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class AdaptiveConcurrencyController:
+    """Tune the number of in-flight LLM requests to the measured throughput.
+
+    Uses additive-increase / multiplicative-decrease on each request's decode
+    rate: output tokens divided by the time spent outside prompt processing.
+    Unlike latency per prompt token, that rate does not swing with submission
+    length, but it does fall when requests queue inside Ollama or share the GPU.
+
+    Once a full window of requests started under the current limit completes,
+    the window's median rate is compared with a decaying best rate. If it stays
+    within latency_tolerance of the best the limit grows by one; otherwise it is
+    cut back. A transport failure cuts the limit at once, but only once for all
+    requests that were in flight together. Samples from requests started under
+    an earlier limit are discarded, since they say nothing about the new one.
+    """
+
+    def __init__(self, max_concurrency: int = 4, min_concurrency: int = 1,
+                 initial_concurrency: Optional[int] = None,
+                 latency_tolerance: float = 1.5, backoff_factor: float = 0.5,
+                 baseline_decay: float = 0.9):
+        """
+        Initialize the controller
+
+        Args:
+            max_concurrency: Hard ceiling on in-flight requests
+            min_concurrency: Floor the limit never drops below
+            initial_concurrency: Starting limit (defaults to min_concurrency)
+            latency_tolerance: Allowed ratio of best decode rate to window median
+            backoff_factor: Multiplier applied to the limit on congestion
+            baseline_decay: Per-window decay of the best decode rate, so one
+                unusually fast request cannot hold the baseline forever
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        if initial_concurrency is None:
+            initial_concurrency = self.min_concurrency
+        self.limit = max(self.min_concurrency, min(initial_concurrency, self.max_concurrency))
+        self.latency_tolerance = latency_tolerance
+        self.backoff_factor = backoff_factor
+        self.baseline_decay = baseline_decay
+
+        self.in_flight = 0
+        self.best_tokens_per_second = None
+        self._epoch = 0
+        self._window = []
+        self._completed = 0
+        self._window_start = time.monotonic()
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Block until a request slot is free and hold it for the duration.
+
+        Yields the epoch the request started in; pass it back to record() or
+        record_failure().
+        """
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            epoch = self._epoch
+        try:
+            yield epoch
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def record(self, latency: float, output_tokens: int, prefill_seconds: float = 0.0,
+               epoch: Optional[int] = None):
+        """Record a completed request and adjust the limit once the window is full"""
+        with self._condition:
+            self._completed += 1
+            if epoch is not None and epoch != self._epoch:
+                return
+            decode_seconds = max(latency - prefill_seconds, 1e-3)
+            self._window.append((output_tokens, output_tokens / decode_seconds))
+            if len(self._window) >= self.limit:
+                self._adjust()
+
+    def record_failure(self, epoch: Optional[int] = None):
+        """Record a connection failure or timeout and back off once per window"""
+        with self._condition:
+            self._completed += 1
+            if epoch is not None and epoch != self._epoch:
+                # Already cut for the batch this request belonged to
+                return
+            self._set_limit(
+                max(self.min_concurrency, int(self.limit * self.backoff_factor)),
+                "request failed to reach the model"
+            )
+
+    def _adjust(self):
+        """Apply one AIMD step using the current window of samples"""
+        rates = sorted(rate for _, rate in self._window)
+        median_rate = rates[len(rates) // 2]
+        if self.best_tokens_per_second is None:
+            self.best_tokens_per_second = rates[-1]
+        else:
+            self.best_tokens_per_second = max(rates[-1], self.best_tokens_per_second * self.baseline_decay)
+
+        if median_rate * self.latency_tolerance < self.best_tokens_per_second:
+            reason = (f"median {median_rate:.1f} tokens/s per request below "
+                      f"best {self.best_tokens_per_second:.1f} / {self.latency_tolerance}")
+            self._set_limit(max(self.min_concurrency, int(self.limit * self.backoff_factor)), reason)
+        else:
+            reason = f"median {median_rate:.1f} tokens/s per request within tolerance"
+            self._set_limit(min(self.max_concurrency, self.limit + 1), reason)
+
+    def _set_limit(self, new_limit: int, reason: str):
+        """Log the decision and start a new window under the new limit"""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        total_tokens = sum(tokens for tokens, _ in self._window)
+        throughput = total_tokens / elapsed if elapsed > 0 else 0.0
+
+        old_limit = self.limit
+        self.limit = new_limit
+        if new_limit > old_limit:
+            action = "increase"
+        elif new_limit < old_limit:
+            action = "decrease"
+        else:
+            action = "hold"
+        print(f"[concurrency] {action} {old_limit} -> {new_limit} "
+              f"({reason}; ~{throughput:.1f} output tokens/s over {self._completed} completed)")
+
+        self._epoch += 1
+        self._window = []
+        self._window_start = now
+        self._condition.notify_all()
@@ -23,6 +23,32 @@ LLM_CONFIG = {
     'model_name': 'llama2:3.2',
     'temperature': 0.1,
     'max_tokens': 1000,
+    # Adaptive concurrency: in-flight requests to Ollama grow from
+    # min_concurrency up to max_concurrency while each request's decode rate
+    # (output tokens/s, excluding prompt processing) holds up
+    'max_concurrency': 4,
+    'min_concurrency': 1,
+    # Back off when the best recent decode rate exceeds a window's median
+    # decode rate by more than this factor
+    'latency_tolerance': 1.5,
+    # Record/replay: None for live calls, 'record' to archive every raw prompt
+    # and response, 'replay' to re-run a grading pass from the archive offline
+    'record_mode': None,
+    'archive_path': os.path.join(BASE_DIR, 'llm_calls.zip'),
+    'archive_flush_every': 10,  # Recorded calls between flushes to disk
+}
+
+# Submission preprocessing (applied before submissions reach the model)
+PREPROCESS_CONFIG = {
+    'enabled': True,
+    'template_dir': None,  # Starter code directory; unchanged starter lines are stripped
+    'drop_duplicates': True,
+    'max_output_lines': 40,  # Longer runs of output-like lines keep only head and tail
+    'max_line_chars': 500,  # Longer lines in code and pasted output are cut
+    'max_literal_chars': 300,  # Longer string literals in code (not docstrings) are cut
+    'max_file_chars': 0,  # If set, larger files keep only their head and tail
+    'minify': False,  # Drop blank lines and trailing whitespace in code
+    'strip_comments': False,  # With minify, also drop code comments
 }
 
 # File patterns
@@ -6,16 +6,39 @@ from langchain_ollama import OllamaLLM
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from langchain.output_parsers import PydanticOutputParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import RunnableLambda
 from pydantic import BaseModel, Field
 import pandas as pd
 from operator import itemgetter
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import ollama
+from adaptive_concurrency import AdaptiveConcurrencyController
+from config import LLM_CONFIG, PREPROCESS_CONFIG
+from llm_recorder import open_archive
+from submission_preprocessor import (
+    estimate_tokens, load_template_files, preprocess_files, report_token_savings, should_skip_dir
+)
 
 # Define the expected output structure
 class GradingResult(BaseModel):
     grade: float = Field(description="The numerical grade for the submission")
     feedback: str = Field(description="Detailed feedback explaining the grade")
 
+def is_congestion_error(error: Exception) -> bool:
+    """Check whether a failure means Ollama is overloaded or unreachable"""
+    if isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return False
+
 class LLMGrader:
     GRADING_TEMPLATE = """
     Please grade this assignment according to the following rubric:
@@ -27,11 +50,37 @@ class LLMGrader:
     Provide a grade out of 100 and detailed feedback.
     """
 
-    def __init__(self, model_name: str = "llama2"):
-        """Initialize the LLM grader with LangChain components"""
-        self.llm = OllamaLLM(model=model_name)
+    def __init__(self, model_name: str = "llama2", temperature: float = None, max_tokens: int = None,
+                 record_mode: str = None, archive_path: str = None):
+        """
+        Initialize the LLM grader with LangChain components
+
+        Args:
+            model_name: Ollama model to grade with
+            temperature: Sampling temperature (Ollama's default if None)
+            max_tokens: Maximum tokens to generate (Ollama's default if None)
+            record_mode: None for live calls, 'record' to archive every call,
+                or 'replay' to answer from the archive without a model
+            archive_path: Location of the recorded call archive
+        """
+        if record_mode is None:
+            record_mode = LLM_CONFIG.get('record_mode')
+        if archive_path is None:
+            archive_path = LLM_CONFIG.get('archive_path')
+        # Everything that shapes the response is part of the record/replay key;
+        # options left unset use Ollama's defaults and are left out of both
+        self.llm_params = {'model': model_name}
+        if temperature is not None:
+            self.llm_params['temperature'] = temperature
+        if max_tokens is not None:
+            self.llm_params['num_predict'] = max_tokens
+        self.archive = open_archive(record_mode, archive_path, LLM_CONFIG.get('archive_flush_every', 10))
+        # Replay never talks to Ollama, so no model is needed
+        self.llm = None if record_mode == 'replay' else OllamaLLM(**self.llm_params)
         
         self.output_parser = PydanticOutputParser(pydantic_object=GradingResult)
+        # Per-thread stats for the most recent model call, read by _grade
+        self._local = threading.local()
         self.grading_chain = self._create_grading_chain()
 
     def _load_text(self, file_path: str) -> str:
@@ -50,21 +99,8 @@ class LLMGrader:
     def grade_submission(self, rubric_text: str, submission_text: str) -> Dict:
         """Grade a single submission using LangChain"""
         try:
-            result = self.grading_chain.invoke({
-                "rubric_content": rubric_text,
-                "submission_content": submission_text
-            })
-            
-            # Parse the result
-            try:
-                parsed_result = self.output_parser.parse(result)
-                return {
-                    'grade': parsed_result.grade,
-                    'feedback': parsed_result.feedback
-                }
-            except Exception as parse_error:
-                # Fallback to basic parsing if structured parsing fails
-                return self._basic_parse_result(result)
+            grade_result, _ = self._grade(rubric_text, submission_text)
+            return grade_result
             
         except Exception as e:
             print(f"Error grading submission: {str(e)}")
@@ -73,6 +109,65 @@ class LLMGrader:
                 'feedback': f"Error during grading: {str(e)}"
             }
 
+    def _grade(self, rubric_text: str, submission_text: str):
+        """Grade a submission and return (result, call stats); model call failures propagate"""
+        self._local.stats = {}
+        try:
+            result = self.grading_chain.invoke({
+                "rubric_content": rubric_text,
+                "submission_content": submission_text
+            })
+        except OutputParserException:
+            # The model answered, just not in the expected structure
+            return self._basic_parse_result(self._local.stats.get('response', '')), self._local.stats
+        
+        # Parse the result
+        try:
+            parsed_result = self.output_parser.parse(result)
+            return {
+                'grade': parsed_result.grade,
+                'feedback': parsed_result.feedback
+            }, self._local.stats
+        except Exception as parse_error:
+            # Fallback to basic parsing if structured parsing fails
+            return self._basic_parse_result(result), self._local.stats
+
+    def _call_llm(self, prompt_value) -> str:
+        """Send the formatted prompt to the model, recording or replaying raw calls"""
+        prompt_text = prompt_value.to_string()
+        if self.archive is not None and self.archive.mode == 'replay':
+            response = self.archive.lookup(prompt_text, self.llm_params)
+            self._local.stats = {'response': response, 'output_tokens': estimate_tokens(response),
+                                 'prefill_seconds': 0.0}
+            return response
+        
+        start = time.monotonic()
+        generation = self.llm.generate([prompt_text]).generations[0][0]
+        response = generation.text
+        if self.archive is not None:
+            self.archive.record(prompt_text, self.llm_params, response, time.monotonic() - start)
+        
+        # Ollama reports token counts and durations (in nanoseconds) with the final chunk
+        info = generation.generation_info or {}
+        self._local.stats = {
+            'response': response,
+            'output_tokens': info.get('eval_count') or estimate_tokens(response),
+            'prefill_seconds': ((info.get('load_duration') or 0) + (info.get('prompt_eval_duration') or 0)) / 1e9,
+        }
+        return response
+
+    def close(self):
+        """Flush the recorded call archive, if any"""
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        """Use the grader as a context manager so the archive is always closed"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def _basic_parse_result(self, result: str) -> Dict:
         """Fallback parsing method for when structured parsing fails"""
         return {
@@ -86,7 +181,7 @@ class LLMGrader:
             template=self.GRADING_TEMPLATE,
             input_variables=["rubric_content", "submission_content"]
         )
-        return prompt | self.llm | self.output_parser
+        return prompt | RunnableLambda(self._call_llm) | self.output_parser
 
 def parse_student_name(directory_name):
     """Extract first and last name from directory name."""
@@ -110,17 +205,18 @@ def find_python_file(directory):
                 return os.path.join(root, file)
     return None
 
-def read_directory_contents(directory):
+def read_directory_contents(directory, templates=None):
     """Read all text files in a directory and combine their contents."""
     contents = []
     print(f"\nScanning directory: {directory}")
     print(f"Directory exists: {os.path.exists(directory)}")
     
     try:
-        files_list = list(os.walk(directory))
-        print(f"Files found in directory: {files_list}")
-        
-        for root, dirs, files in files_list:
+        for root, dirs, files in os.walk(directory):
+            skipped = [d for d in dirs if should_skip_dir(d)]
+            if skipped:
+                print(f"Skipping directories: {skipped}")
+            dirs[:] = [d for d in dirs if not should_skip_dir(d)]
             print(f"\nIn subdirectory: {root}")
             print(f"Found files: {files}")
             
@@ -136,13 +232,13 @@ def read_directory_contents(directory):
                             text = ''
                             for page in pdf_reader.pages:
                                 text += page.extract_text() + '\n'
-                            contents.append(text)
+                            contents.append((os.path.relpath(file_path, directory), text))
                             print(f"Successfully read PDF: {file_path}")
                     
                     elif file.endswith(('.py', '.cpp', '.txt', '.md', '.text')):
                         with open(file_path, 'r', encoding='utf-8') as f:
                             content = f.read()
-                            contents.append(content)
+                            contents.append((os.path.relpath(file_path, directory), content))
                             print(f"Successfully read file: {file_path}")
                     
                     else:
@@ -158,7 +254,15 @@ def read_directory_contents(directory):
         print(f"No readable content found in {directory}")
         return None
     
-    return '\n\n'.join(contents)
+    if PREPROCESS_CONFIG.get('enabled', False):
+        processed = preprocess_files(contents, PREPROCESS_CONFIG, templates)
+        report_token_savings(os.path.basename(directory), contents, processed)
+        contents = processed
+        if not contents:
+            print(f"No content left in {directory} after preprocessing")
+            return None
+    
+    return '\n\n'.join(text for _, text in contents)
 
 def grade_assignments(submissions_dir, rubric_path, output_path):
     results = []
@@ -174,7 +278,14 @@ def grade_assignments(submissions_dir, rubric_path, output_path):
     
     # Initialize grader
     grader = LLMGrader()
+    templates = load_template_files(PREPROCESS_CONFIG.get('template_dir'))
+    controller = AdaptiveConcurrencyController(
+        max_concurrency=LLM_CONFIG.get('max_concurrency', 1),
+        min_concurrency=LLM_CONFIG.get('min_concurrency', 1),
+        latency_tolerance=LLM_CONFIG.get('latency_tolerance', 1.5)
+    )
     
+    submissions = []
     for submission_dir in os.listdir(submissions_dir):
         if '_assignsubmission_file_' in submission_dir:
             print(f"\nProcessing submission: {submission_dir}")
@@ -183,31 +294,59 @@ def grade_assignments(submissions_dir, rubric_path, output_path):
             
             # Read all text contents from the submission directory
             full_submission_dir = os.path.join(submissions_dir, submission_dir)
-            submission_text = read_directory_contents(full_submission_dir)
-            
-            if submission_text is None:
-                grade_result = {
+            submission_text = read_directory_contents(full_submission_dir, templates)
+            submissions.append((first_name, last_name, full_submission_dir, submission_text))
+    
+    def grade_one(full_submission_dir, submission_text):
+        if submission_text is None:
+            return {
+                'grade': 0,
+                'feedback': f'No readable content found in submission directory: {full_submission_dir}'
+            }
+        with controller.slot() as epoch:
+            start = time.monotonic()
+            try:
+                # Pass the text content directly to the grading method
+                grade_result, stats = grader._grade(rubric_text=rubric_text, submission_text=submission_text)
+            except Exception as e:
+                print(f"Error during grading: {str(e)}")
+                # Only an overloaded or unreachable model is a reason to back off
+                if is_congestion_error(e):
+                    controller.record_failure(epoch)
+                return {
                     'grade': 0,
-                    'feedback': f'No readable content found in submission directory: {full_submission_dir}'
+                    'feedback': f'Error during grading: {str(e)}'
                 }
-            else:
-                try:
-                    # Pass the text content directly to the grading method
-                    grade_result = grader.grade_submission(rubric_text=rubric_text, submission_text=submission_text)
-                except Exception as e:
-                    print(f"Error during grading: {str(e)}")
-                    grade_result = {
-                        'grade': 0,
-                        'feedback': f'Error during grading: {str(e)}'
-                    }
-            
-            results.append({
-                'First Name': first_name,
-                'Last Name': last_name,
-                'Grade': grade_result['grade'],
-                'Feedback': grade_result['feedback']
-            })
+            latency = time.monotonic() - start
+        controller.record(latency, stats['output_tokens'], stats['prefill_seconds'], epoch)
+        return grade_result
+    
+    try:
+        # Threads only wait on Ollama; the controller decides how many run at once
+        executor = ThreadPoolExecutor(max_workers=controller.max_concurrency)
+        try:
+            futures = [
+                executor.submit(grade_one, full_submission_dir, submission_text)
+                for _, _, full_submission_dir, submission_text in submissions
+            ]
+            for (first_name, last_name, _, _), future in zip(submissions, futures):
+                grade_result = future.result()
+                results.append({
+                    'First Name': first_name,
+                    'Last Name': last_name,
+                    'Grade': grade_result['grade'],
+                    'Feedback': grade_result['feedback']
+                })
+        except BaseException:
+            # On Ctrl-C or an error, drop queued submissions instead of grading them all
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+    finally:
+        # Save recorded calls even if grading is interrupted
+        grader.close()
     
+    print(f"Final concurrency limit: {controller.limit} (ceiling {controller.max_concurrency})")
     print(f"\nSaving results to: {output_path}")
     df = pd.DataFrame(results)
     df.to_csv(output_path, index=False)
@@ -0,0 +1,172 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+from typing import Dict, Optional
+
+INDEX_NAME = 'index.json'
+
+
+class ReplayMissError(LookupError):
+    """Raised in replay mode when a prompt was never recorded"""
+
+
+def call_key(prompt: str, params: Dict) -> str:
+    """Stable identifier for a prompt sent with the given model parameters"""
+    payload = json.dumps({'prompt': prompt, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCallArchive:
+    """Compressed archive of raw LLM calls used for record and replay.
+
+    The archive is a zip file with one deflated JSON entry per call, named by
+    its call_key, plus an index.json summarising every entry. Existing entries
+    are loaded into memory when the archive is opened, so replay lookups never
+    touch the disk or a model.
+
+    While recording, new calls are written to numbered .partial segment zips,
+    each closed after flush_every calls. The archive itself is only replaced in
+    close(); if a run dies first, the next open recovers every closed segment.
+    """
+
+    def __init__(self, path: str, mode: str = 'replay', flush_every: int = 10):
+        """
+        Open an archive
+
+        Args:
+            path: Location of the .zip archive
+            mode: 'record' to store new calls, 'replay' to serve stored ones
+            flush_every: Number of recorded calls between flushes to disk
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown archive mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.flush_every = max(1, flush_every)
+        self.entries = self._load(path)
+        for segment_path in self._segment_paths():
+            recovered = self._load(segment_path)
+            if recovered:
+                print(f"Recovered {len(recovered)} LLM calls from interrupted run {segment_path}")
+                self.entries.update(recovered)
+        self._lock = threading.Lock()
+        self._zip = None
+        self._segment = 0
+        self._unflushed = 0
+        self._recorded = set()
+
+        if mode == 'replay':
+            if not self.entries:
+                raise FileNotFoundError(f"No recorded LLM calls found at {path}")
+            print(f"Replaying {len(self.entries)} recorded LLM calls from {path}")
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._segment = len(self._segment_paths())
+            self._zip = self._open_segment()
+            print(f"Recording LLM calls to {path} ({len(self.entries)} existing)")
+
+    @staticmethod
+    def _load(path: str) -> Dict[str, Dict]:
+        """Read every recorded call from an existing archive"""
+        entries = {}
+        if not os.path.exists(path):
+            return entries
+        try:
+            with zipfile.ZipFile(path, 'r') as archive:
+                for name in archive.namelist():
+                    if name == INDEX_NAME or not name.endswith('.json'):
+                        continue
+                    entries[name[:-len('.json')]] = json.loads(archive.read(name))
+        except zipfile.BadZipFile as e:
+            # A segment that was still open when a run died has no central directory
+            print(f"Error reading LLM call archive {path}: {str(e)}")
+        return entries
+
+    def lookup(self, prompt: str, params: Dict) -> str:
+        """Return the recorded raw response for a prompt"""
+        entry = self.entries.get(call_key(prompt, params))
+        if entry is None:
+            raise ReplayMissError(f"No recorded response for prompt with params {params}")
+        return entry['response']
+
+    def record(self, prompt: str, params: Dict, response: str, latency: float):
+        """Store a raw prompt and response"""
+        key = call_key(prompt, params)
+        entry = {
+            'prompt': prompt,
+            'params': params,
+            'response': response,
+            'latency': latency,
+            'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with self._lock:
+            if key in self._recorded or self._zip is None:
+                # Identical prompts within a run are answered once; keep the first response
+                return
+            # Responses from earlier runs are replaced, so replay serves the latest model
+            self._recorded.add(key)
+            self.entries[key] = entry
+            self._zip.writestr(f"{key}.json", json.dumps(entry))
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush()
+
+    def _segment_paths(self):
+        """Segments left behind by runs that did not reach close()"""
+        return sorted(glob.glob(f"{glob.escape(self.path)}.partial*"))
+
+    def _open_segment(self) -> zipfile.ZipFile:
+        """Start the next segment for newly recorded calls"""
+        segment_path = f"{self.path}.partial{self._segment:04d}"
+        self._segment += 1
+        return zipfile.ZipFile(segment_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9)
+
+    def _flush(self):
+        """Close the current segment so its calls survive a crash"""
+        self._zip.close()
+        self._zip = self._open_segment()
+        self._unflushed = 0
+
+    def close(self):
+        """Write the index and finish the archive"""
+        with self._lock:
+            if self._zip is None:
+                return
+            index = {
+                key: {
+                    'params': entry['params'],
+                    'prompt_chars': len(entry['prompt']),
+                    'response_chars': len(entry['response']),
+                    'latency': entry['latency'],
+                }
+                for key, entry in self.entries.items()
+            }
+            self._zip.close()
+            self._zip = None
+
+            # Rewrite the whole archive so re-recording a run never leaves duplicate
+            # entries; the old archive is only replaced once the new one is complete
+            with zipfile.ZipFile(f"{self.path}.tmp", 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=9) as archive:
+                for key, entry in self.entries.items():
+                    archive.writestr(f"{key}.json", json.dumps(entry))
+                archive.writestr(INDEX_NAME, json.dumps(index, indent=2))
+            os.replace(f"{self.path}.tmp", self.path)
+            for segment_path in self._segment_paths():
+                os.remove(segment_path)
+            print(f"Saved {len(self.entries)} LLM calls to {self.path}")
+
+
+def open_archive(mode: Optional[str], path: Optional[str], flush_every: int = 10) -> Optional[LLMCallArchive]:
+    """Open an archive for the configured mode, or return None for live calls only"""
+    if not mode:
+        return None
+    if not path:
+        raise ValueError(f"LLM_CONFIG['archive_path'] must be set for '{mode}' mode")
+    return LLMCallArchive(path, mode, flush_every)
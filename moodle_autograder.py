@@ -75,6 +75,10 @@ class AssignmentGrader:
         # Use LLM grader to grade the submission
         return self.llm_grader.grade_submission(self.rubric, submission_text)
 
+    def close(self):
+        """Release the LLM grader (saves recorded calls in record mode)"""
+        self.llm_grader.close()
+
 def grade_submissions(submissions_dir: str, rubric_path: str) -> pd.DataFrame:
     """
     Grade all submissions in a directory
@@ -91,23 +95,26 @@ def grade_submissions(submissions_dir: str, rubric_path: str) -> pd.DataFrame:
     
     # Grade submissions and collect results
     results = []
-    for submission_path in Path(submissions_dir).glob('*.pdf'):
-        student_name = submission_path.stem
-        try:
-            grade_result = assignment_grader.grade_submission(str(submission_path))
-            results.append({
-                'Student Name': student_name,
-                'Grade': grade_result['grade'],
-                'Feedback': grade_result['feedback'],
-                'Status': 'Success'
-            })
-        except Exception as e:
-            results.append({
-                'Student Name': student_name,
-                'Grade': 0,
-                'Feedback': f'Error: {str(e)}',
-                'Status': 'Failed'
-            })
+    try:
+        for submission_path in Path(submissions_dir).glob('*.pdf'):
+            student_name = submission_path.stem
+            try:
+                grade_result = assignment_grader.grade_submission(str(submission_path))
+                results.append({
+                    'Student Name': student_name,
+                    'Grade': grade_result['grade'],
+                    'Feedback': grade_result['feedback'],
+                    'Status': 'Success'
+                })
+            except Exception as e:
+                results.append({
+                    'Student Name': student_name,
+                    'Grade': 0,
+                    'Feedback': f'Error: {str(e)}',
+                    'Status': 'Failed'
+                })
+    finally:
+        assignment_grader.close()
     
     return pd.DataFrame(results)
 
@@ -0,0 +1,305 @@
+import difflib
+import hashlib
+import io
+import os
+import re
+import tokenize
+from typing import Dict, List, Optional, Tuple
+
+# Folders that never contain anything worth grading
+SKIP_DIRS = {'__pycache__', '.ipynb_checkpoints', '.git', '.venv', 'venv', 'node_modules', '.pytest_cache'}
+
+TEXT_EXTENSIONS = ('.py', '.cpp', '.txt', '.md', '.text')
+
+CODE_EXTENSIONS = ('.py', '.cpp')
+
+# Comments are matched first so quotes inside them are never taken for literals
+C_LITERAL_PATTERN = re.compile(
+    r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.DOTALL
+)
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Rough token count (about four characters per token)"""
+    return sum(len(text or '') for text in texts) // 4
+
+
+def should_skip_dir(name: str) -> bool:
+    """Check whether a directory should be pruned from the walk"""
+    return name in SKIP_DIRS or name.endswith('.egg-info')
+
+
+def load_template_files(template_dir: Optional[str]) -> Dict[str, str]:
+    """Read starter code files keyed by their path relative to template_dir"""
+    templates = {}
+    if not template_dir or not os.path.isdir(template_dir):
+        return templates
+    for root, dirs, files in os.walk(template_dir):
+        dirs[:] = [d for d in dirs if not should_skip_dir(d)]
+        for file in files:
+            if not file.endswith(TEXT_EXTENSIONS):
+                continue
+            file_path = os.path.join(root, file)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    templates[os.path.relpath(file_path, template_dir)] = f.read()
+            except Exception as e:
+                print(f"Error reading template file {file_path}: {str(e)}")
+    return templates
+
+
+def strip_starter_code(text: str, template: str, context: int = 2) -> str:
+    """Keep the lines the student added or changed relative to the template,
+    plus a few unchanged lines around each change so the model can see where
+    the new code lives"""
+    student_lines = text.splitlines()
+    matcher = difflib.SequenceMatcher(None, template.splitlines(), student_lines, autojunk=False)
+    opcodes = matcher.get_opcodes()
+    kept = []
+    for index, (tag, _, _, j1, j2) in enumerate(opcodes):
+        if tag in ('replace', 'insert'):
+            kept.extend(student_lines[j1:j2])
+        elif tag == 'equal':
+            head = context if index > 0 else 0
+            tail = context if index < len(opcodes) - 1 else 0
+            if j2 - j1 <= head + tail:
+                kept.extend(student_lines[j1:j2])
+                continue
+            kept.extend(student_lines[j1:j1 + head])
+            omitted = student_lines[j1 + head:j2 - tail]
+            # Blank lines are not worth a marker
+            if any(line.strip() for line in omitted):
+                kept.append(f"... [{len(omitted)} lines of starter code omitted] ...")
+            kept.extend(student_lines[j2 - tail:j2])
+    return '\n'.join(kept)
+
+
+def find_template(rel_path: str, text: str, templates: Dict[str, str]) -> Optional[str]:
+    """Find the template a submitted file was derived from"""
+    if rel_path in templates:
+        return templates[rel_path]
+    # Students often nest or rename folders, so fall back to the file name
+    base_name = os.path.basename(rel_path)
+    candidates = [t for path, t in templates.items() if os.path.basename(path) == base_name]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda t: difflib.SequenceMatcher(None, t, text, autojunk=False).quick_ratio())
+
+
+def _shorten_literal(literal: str, max_chars: int) -> str:
+    """Replace the body of a quoted literal with its first characters and a marker"""
+    prefix_length = len(literal) - len(literal.lstrip('rRbBuUfF'))
+    quote = literal[prefix_length:prefix_length + 3]
+    if quote not in ('"""', "'''"):
+        quote = literal[prefix_length]
+    body = literal[prefix_length + len(quote):-len(quote)]
+    if len(body) <= max_chars:
+        return literal
+    keep = max_chars // 2
+    return f"{literal[:prefix_length]}{quote}{body[:keep]}...[{len(body) - keep} chars truncated]{quote}"
+
+
+def _shorten_python_literals(text: str, max_chars: int) -> str:
+    """Shorten long string tokens in Python source, leaving docstrings intact"""
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return text
+
+    line_offsets = [0]
+    for line in text.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    skip = {tokenize.NL, tokenize.COMMENT}
+    significant = [tok for tok in tokens if tok.type not in skip]
+    replacements = []
+    for index, tok in enumerate(significant):
+        if tok.type != tokenize.STRING:
+            continue
+        previous = significant[index - 1].type if index > 0 else tokenize.NEWLINE
+        following = significant[index + 1].type if index + 1 < len(significant) else tokenize.NEWLINE
+        # A string that is a statement on its own is a docstring (or used as one)
+        if previous in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENCODING) \
+                and following in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            continue
+        shortened = _shorten_literal(tok.string, max_chars)
+        if shortened != tok.string:
+            start = line_offsets[tok.start[0] - 1] + tok.start[1]
+            end = line_offsets[tok.end[0] - 1] + tok.end[1]
+            replacements.append((start, end, shortened))
+
+    for start, end, shortened in reversed(replacements):
+        text = text[:start] + shortened + text[end:]
+    return text
+
+
+def _shorten_c_literals(text: str, max_chars: int) -> str:
+    """Shorten long string literals in C/C++ source, ignoring comments"""
+    return C_LITERAL_PATTERN.sub(
+        lambda m: m.group(0) if m.group(0).startswith('/') else _shorten_literal(m.group(0), max_chars),
+        text
+    )
+
+
+def shorten_literals(text: str, file_name: str, max_chars: int) -> str:
+    """Shorten string literals longer than max_chars in a source file"""
+    if not max_chars:
+        return text
+    if file_name.endswith('.py'):
+        return _shorten_python_literals(text, max_chars)
+    if file_name.endswith('.cpp'):
+        return _shorten_c_literals(text, max_chars)
+    return text
+
+
+def _is_output_line(line: str, previous: str) -> bool:
+    """Guess whether a line continues a block of program output or data"""
+    stripped = line.strip()
+    if not stripped:
+        return False
+    # Output repeats the same shape with different numbers (loss logs, tables, prints in a loop)
+    if re.sub(r'\d+', '0', stripped) == re.sub(r'\d+', '0', previous.strip()):
+        return True
+    visible = [c for c in stripped if not c.isspace()]
+    letters = sum(c.isalpha() for c in visible)
+    return letters < 0.3 * len(visible)
+
+
+def collapse_output_runs(text: str, max_run_lines: int, max_line_chars: int = 0) -> str:
+    """Cut long runs of output-like lines down to their head and tail.
+
+    Prose and ordinary code are left alone; only blocks where each line looks
+    like the previous one (or is mostly numbers and symbols) are shortened.
+    """
+    lines = text.splitlines()
+    result = []
+    index = 0
+    while index < len(lines):
+        end = index + 1
+        while end < len(lines) and _is_output_line(lines[end], lines[end - 1]):
+            end += 1
+        run = lines[index:end]
+        if max_run_lines and len(run) > max_run_lines:
+            if max_line_chars:
+                # The first line only starts the run and may be ordinary prose
+                run = run[:1] + [
+                    f"{line[:max_line_chars]} ...[{len(line) - max_line_chars} chars truncated]"
+                    if len(line) > max_line_chars else line
+                    for line in run[1:]
+                ]
+            head = run[:max_run_lines // 2]
+            tail = run[-(max_run_lines // 4):] if max_run_lines >= 4 else []
+            omitted = len(run) - len(head) - len(tail)
+            run = head + [f"...[{omitted} similar output lines truncated]..."] + tail
+        result.extend(run)
+        index = end
+    return '\n'.join(result)
+
+
+def truncate_text(text: str, file_name: str, config: Dict) -> str:
+    """Shorten long literals, pasted output, long code lines and (optionally) oversized files"""
+    is_code = file_name.endswith(CODE_EXTENSIONS)
+    max_line_chars = config.get('max_line_chars', 0)
+
+    # Repetitive code (unrolled assignments, test tables) is still student work
+    if not is_code:
+        text = collapse_output_runs(text, config.get('max_output_lines', 0), max_line_chars)
+
+    # Prose keeps whole paragraphs on one line, so only code lines are cut
+    if max_line_chars and is_code:
+        lines = []
+        for line in text.splitlines():
+            if len(line) > max_line_chars:
+                line = f"{line[:max_line_chars]} ...[{len(line) - max_line_chars} chars truncated]"
+            lines.append(line)
+        text = '\n'.join(lines)
+
+    max_file_chars = config.get('max_file_chars', 0)
+    if max_file_chars and len(text) > max_file_chars:
+        half = max_file_chars // 2
+        omitted = len(text) - 2 * half
+        text = f"{text[:half]}\n...[{omitted} chars truncated]...\n{text[-half:]}"
+    return text
+
+
+def _strip_python_comments(text: str) -> str:
+    """Remove # comments from Python source, leaving strings untouched"""
+    try:
+        tokens = [
+            tok for tok in tokenize.generate_tokens(io.StringIO(text).readline)
+            if tok.type != tokenize.COMMENT
+        ]
+        return tokenize.untokenize(tokens)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return text
+
+
+def _strip_c_comments(text: str) -> str:
+    """Remove // and /* */ comments from C/C++ source, leaving strings untouched"""
+    return C_LITERAL_PATTERN.sub(lambda m: '' if m.group(0).startswith('/') else m.group(0), text)
+
+
+def minify_code(text: str, file_name: str, strip_comments: bool = False) -> str:
+    """Drop comments, trailing whitespace and blank lines from source files"""
+    if strip_comments:
+        if file_name.endswith('.py'):
+            text = _strip_python_comments(text)
+        elif file_name.endswith('.cpp'):
+            text = _strip_c_comments(text)
+    return '\n'.join(line.rstrip() for line in text.splitlines() if line.strip())
+
+
+def preprocess_files(files: List[Tuple[str, str]], config: Dict,
+                     templates: Optional[Dict[str, str]] = None) -> List[Tuple[str, str]]:
+    """
+    Shrink submission files before they are sent to the model
+
+    Args:
+        files: List of (relative path, text) pairs in reading order
+        config: PREPROCESS_CONFIG-style settings
+        templates: Starter code keyed by relative path (see load_template_files)
+
+    Returns:
+        List of (relative path, text) pairs that should be graded
+    """
+    templates = templates or {}
+    seen_hashes = set()
+    processed = []
+    for rel_path, text in files:
+        if config.get('drop_duplicates', True):
+            digest = hashlib.sha256(text.strip().encode('utf-8')).hexdigest()
+            if digest in seen_hashes:
+                print(f"Dropping duplicate file: {rel_path}")
+                continue
+            seen_hashes.add(digest)
+
+        # Literals are shortened before diffing, while the source still tokenizes
+        max_literal_chars = config.get('max_literal_chars', 0)
+        text = shorten_literals(text, rel_path, max_literal_chars)
+
+        if templates and rel_path.endswith(TEXT_EXTENSIONS):
+            template = find_template(rel_path, text, templates)
+            if template is not None:
+                template = shorten_literals(template, rel_path, max_literal_chars)
+                if text.strip() == template.strip():
+                    print(f"Dropping unmodified starter file: {rel_path}")
+                    continue
+                text = strip_starter_code(text, template)
+
+        text = truncate_text(text, rel_path, config)
+
+        if config.get('minify', False) and rel_path.endswith(CODE_EXTENSIONS):
+            text = minify_code(text, rel_path, config.get('strip_comments', False))
+
+        if text.strip():
+            processed.append((rel_path, text))
+    return processed
+
+
+def report_token_savings(label: str, before: List[Tuple[str, str]], after: List[Tuple[str, str]]) -> Dict:
+    """Print and return estimated prompt tokens before and after preprocessing"""
+    tokens_before = estimate_tokens(*(text for _, text in before))
+    tokens_after = estimate_tokens(*(text for _, text in after))
+    saved = 100 * (tokens_before - tokens_after) / tokens_before if tokens_before else 0.0
+    print(f"Preprocessed {label}: ~{tokens_before} -> ~{tokens_after} tokens ({saved:.1f}% smaller)")
+    return {'tokens_before': tokens_before, 'tokens_after': tokens_after}